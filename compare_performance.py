@@ -1,6 +1,6 @@
 import time
 import pandas as pd
-from portfolio_optimizer import optimize_portfolio, optimize_portfolio_sequential
+from portfolio_optimizer import optimize_portfolio, optimize_portfolio_sequential, prepare_optimization_inputs
 from io_funcs import load_price_data
 
 def print_portfolio_metrics(portfolio, prefix=""):
@@ -14,6 +14,11 @@ def run_performance_comparison():
     # Set parameters
     n_select = 25
     simulation_counts = [2, 10, 50, 100, 500, 1000]  # Test different numbers of simulations
+    seed = 42
+    
+    # Statistics and combinations are the same for every simulation count,
+    # so they are computed once and both versions only time the search
+    precomputed = prepare_optimization_inputs(prices, n_select)
     
     # Store results for summary table
     results = []
@@ -24,13 +29,13 @@ def run_performance_comparison():
         # Run sequential version
         print("\nRunning sequential optimization...")
         start_time = time.time()
-        sequential_result = optimize_portfolio_sequential(prices, n_select, n_simulations)
+        sequential_result = optimize_portfolio_sequential(prices, n_select, n_simulations, seed=seed, precomputed=precomputed)
         sequential_time = time.time() - start_time
         
         # Run parallel version
         print("\nRunning parallel optimization...")
         start_time = time.time()
-        parallel_result = optimize_portfolio(prices, n_select, n_simulations)
+        parallel_result = optimize_portfolio(prices, n_select, n_simulations, seed=seed, precomputed=precomputed)
         parallel_time = time.time() - start_time
         
         # Store results
@@ -1,5 +1,5 @@
 import os
-import json
+import orjson
 from datetime import datetime
 from get_data import get_data
 import pandas as pd
@@ -19,8 +19,9 @@ def load_price_data(data_path: str) -> pd.DataFrame:
 def save_results(portfolio: dict, timestamp: str) -> str:
     """Save portfolio results to a JSON file."""
     results_file = f"portfolio_results_{timestamp}.json"
-    with open(results_file, 'w') as f:
-        json.dump(portfolio, f, indent=4)
+    # orjson serializes numpy scalars directly, no conversion to Python floats needed
+    with open(results_file, 'wb') as f:
+        f.write(orjson.dumps(portfolio, option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY))
     return results_file
 
 def print_portfolio_summary(portfolio: dict, execution_time: float, results_file: str) -> None:
@@ -30,6 +31,7 @@ def print_portfolio_summary(portfolio: dict, execution_time: float, results_file
     print(f"Sharpe Ratio: {portfolio['sharpe_ratio']:.4f}")
     print(f"Annual Return: {portfolio['annual_return']:.4f}")
     print(f"Annual Volatility: {portfolio['annual_volatility']:.4f}")
+    print(f"Seed: {portfolio['seed']}")
     print("\nPortfolio Weights:")
     
     # Sort weights by value in descending order for better presentation
@@ -1,4 +1,3 @@
-import numpy as np
 import time
 import multiprocessing
 from datetime import datetime
@@ -6,9 +5,6 @@ from portfolio_optimizer import optimize_portfolio
 from io_funcs import check_and_get_data, load_price_data, save_results, print_portfolio_summary
 
 def main():
-    # Set random seed for reproducibility
-    np.random.seed(42)
-    
     # Set date range
     start_date = "2024-08-01"
     end_date = "2024-12-31"
@@ -26,6 +22,8 @@ def main():
     
     n_select = 25
     n_simulations = 1000
+    # Set random seed for reproducibility
+    seed = 42
     
     # Optimize portfolio
     print("Optimizing portfolio...")
@@ -33,7 +31,8 @@ def main():
         prices=prices,
         n_select=n_select,
         n_simulations=n_simulations,
-        n_workers=n_workers
+        n_workers=n_workers,
+        seed=seed
     )
     
     # Calculate execution time
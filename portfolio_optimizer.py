@@ -1,65 +1,194 @@
 import numpy as np
 import pandas as pd
-from typing import List, Tuple, Dict
-from multiprocessing import Pool, cpu_count
+from typing import Dict, List, Tuple
+from multiprocessing import get_context, cpu_count
+from multiprocessing.shared_memory import SharedMemory
+from numba import get_num_threads, set_num_threads
 from utils import (
-    calculate_daily_returns,
+    calculate_asset_statistics,
     generate_valid_weights,
     get_stock_combinations,
-    find_best_portfolio_from_batch
+    get_initial_combination,
+    resolve_seed,
+    find_best_portfolio_from_batch,
+    find_best_portfolio_gpu,
+    build_portfolio_result
 )
 
-def process_stock_combination(
-    combination: Tuple[str, ...],
-    returns_array: np.ndarray,
-    column_indices: List[int],
-    n_simulations: int = 1000
-) -> Dict:
-    """Process a single stock combination with vectorized operations."""
+def process_combinations_chunk(args):
+    """Process a chunk of combinations with a single batched evaluation.
+    
+    Returns None only if no portfolio of the chunk beats the incumbent, errors
+    are raised so a failed chunk is never mistaken for a pruned one.
+    """
     try:
-        # Get returns for selected stocks using numpy indexing (much faster)
-        selected_returns = returns_array[:, column_indices]
+        combinations_chunk, mean_returns, cov_matrix, weights_batch, incumbent = args
         
-        # Generate valid weights as a batch
-        weights_batch = generate_valid_weights(len(combination), n_simulations)
-        
-        # Find the best portfolio using vectorized operations
-        return find_best_portfolio_from_batch(selected_returns, weights_batch, combination)
+        # Evaluate all combinations and weights of the chunk at once, skipping
+        # combinations that cannot beat the incumbent
+        return find_best_portfolio_from_batch(
+            mean_returns, cov_matrix, combinations_chunk, weights_batch, incumbent
+        )
     except Exception as e:
-        print(f"Error in process_stock_combination: {e}")
-        return None
+        print(f"Error in process_combinations_chunk: {e}")
+        raise
 
-def process_combinations_chunk(args):
-    """Process a chunk of combinations."""
-    try:
-        combinations_chunk, returns_array, column_map, n_simulations = args
-        results = []
+# Per-process state of the pool workers, filled in by init_worker
+_worker_state = {}
+
+def share_array(array: np.ndarray) -> Tuple[SharedMemory, Tuple]:
+    """Copy an array into a new shared memory block.
+    
+    Returns:
+        Tuple of (shared_memory, spec), where spec is the (name, shape, dtype)
+        that workers need to attach to the block
+    """
+    shm = SharedMemory(create=True, size=max(1, array.nbytes))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[:] = array
+    return shm, (shm.name, array.shape, array.dtype.str)
+
+def init_worker(shared_specs: Dict[str, Tuple], incumbent) -> None:
+    """Attach a pool worker to the shared arrays once, instead of receiving them with every task.
+    
+    The incumbent is a shared double holding the best Sharpe ratio found by
+    any worker so far.
+    """
+    # Run the numba kernel single-threaded to avoid oversubscribing the CPU
+    set_num_threads(1)
+    
+    segments = []
+    for key, (name, shape, dtype) in shared_specs.items():
+        shm = SharedMemory(name=name)
+        segments.append(shm)
+        _worker_state[key] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    # Keep the blocks open for as long as the worker lives
+    _worker_state['segments'] = segments
+    _worker_state['incumbent'] = incumbent
+
+def process_shared_chunk(chunk_bounds: Tuple[int, int]):
+    """Process the (start, stop) slice of the shared combinations using the arrays shared with the worker."""
+    start, stop = chunk_bounds
+    incumbent = _worker_state['incumbent']
+    result = process_combinations_chunk((
+        _worker_state['combinations'][start:stop],
+        _worker_state['mean_returns'],
+        _worker_state['cov_matrix'],
+        _worker_state['weights_batch'],
+        incumbent.value
+    ))
+    
+    # Publish a better Sharpe ratio so other workers can prune against it
+    if result is not None:
+        with incumbent.get_lock():
+            incumbent.value = max(incumbent.value, result[0])
+    return result
+
+def prepare_optimization_inputs(
+    prices: pd.DataFrame,
+    n_select: int = 25
+) -> Tuple[List[str], np.ndarray, np.ndarray, np.ndarray]:
+    """Compute the optimizer inputs that do not depend on the number of simulations.
+    
+    Args:
+        prices: DataFrame with stock prices
+        n_select: Number of stocks to select
         
-        # Process each combination
-        for combination in combinations_chunk:
-            try:
-                # Get column indices for this combination
-                indices = [column_map[stock] for stock in combination]
- 
-                # Process the combination
-                result = process_stock_combination(combination, returns_array, indices, n_simulations)
-                if result is not None:
-                    results.append(result)
-            except Exception as e:
-                print(f"Error processing combination {combination}: {e}")
-                continue
+    Returns:
+        Tuple of (all_stocks, mean_returns, cov_matrix, combinations), which can
+        be passed to the optimizers as precomputed
         
-        return results
-    except Exception as e:
-        print(f"Error in process_combinations_chunk: {e}")
-        return []
+    Raises:
+        ValueError: If prices has too few days to estimate the covariance of
+            n_select stocks
+    """
+    # The covariance of n days of returns has a rank of at most n - 1, so with
+    # fewer return days than that the covariance of a combination is singular
+    n_days = len(prices) - 1
+    if n_days <= n_select:
+        raise ValueError(
+            f"{n_days} days of returns are too few for {n_select} stocks, at least {n_select + 1} are required"
+        )
+    
+    # Annualized statistics are computed once for the whole universe
+    # and sliced per combination, the daily returns are not kept
+    all_stocks, mean_returns, cov_matrix = calculate_asset_statistics(prices)
+    
+    # Get all stock combinations as rows of column indices, tickers are
+    # only looked up when a result is built
+    combinations = get_stock_combinations(len(all_stocks), n_select)
+    print(f"Generated {len(combinations)} combinations")
+    
+    return all_stocks, mean_returns, cov_matrix, combinations
 
-def optimize_portfolio(
+def prepare_optimization(
     prices: pd.DataFrame,
+    n_select: int,
+    n_simulations: int,
+    seed: int = None,
+    precomputed: Tuple = None
+) -> Tuple[Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray], Tuple]:
+    """Prepare the inputs shared by all the optimizers.
+    
+    Args:
+        prices: DataFrame with stock prices, may be None if precomputed is given
+        n_select: Number of stocks to select
+        n_simulations: Number of weight vectors to generate
+        seed: Seed of the weights, one is drawn if not given
+        precomputed: Result of prepare_optimization_inputs, computed from prices if not given
+        
+    Returns:
+        Tuple of (search_inputs, result_inputs), where search_inputs are the
+        (mean_returns, cov_matrix, combinations, weights_batch) of the search,
+        with the weights in float32, and result_inputs are the
+        (all_stocks, mean_returns, cov_matrix, weights_batch, seed) in float64
+        that build_portfolio_result takes after the best portfolio
+        
+    Raises:
+        ValueError: If neither prices nor precomputed are given, if prices has
+            too few days for n_select stocks, or if the precomputed
+            combinations do not select n_select stocks
+    """
+    # Statistics and combinations do not depend on the number of
+    # simulations, callers running several simulation counts pass them in
+    if precomputed is None:
+        if prices is None:
+            raise ValueError("Either prices or precomputed inputs are required")
+        precomputed = prepare_optimization_inputs(prices, n_select)
+    all_stocks, mean_returns, cov_matrix, combinations = precomputed
+    if combinations.shape[1] != n_select:
+        raise ValueError(
+            f"Precomputed combinations select {combinations.shape[1]} stocks, but n_select is {n_select}"
+        )
+    
+    # Every combination has the same size and weight constraints, so a
+    # single batch of weights is generated from one PCG64 stream and
+    # shared by all of them, workers never draw random numbers
+    seed = resolve_seed(seed)
+    weights_batch = generate_valid_weights(n_select, n_simulations, rng=np.random.default_rng(seed))
+    
+    # The weights dominate the memory traffic of the kernels, in float32 it
+    # halves and the SIMD width doubles. The statistics stay in float64, so
+    # covariances are factorized at full precision, a positive definite
+    # covariance may not be one once rounded to float32. The float64 weights
+    # are kept to report the winner at full precision
+    search_inputs = (
+        mean_returns,
+        cov_matrix,
+        combinations,
+        weights_batch.astype(np.float32)
+    )
+    result_inputs = (all_stocks, mean_returns, cov_matrix, weights_batch, seed)
+    
+    return search_inputs, result_inputs
+
+def optimize_portfolio(
+    prices: pd.DataFrame = None,
     n_select: int = 25,
     n_simulations: int = 1000,
     n_workers: int = None,
-    chunk_size: int = None
+    chunk_size: int = None,
+    seed: int = None,
+    precomputed: Tuple = None
 ) -> Dict:
     """Optimize portfolio using parallel processing with chunking."""
     # Set number of workers if not specified
@@ -67,15 +196,10 @@ def optimize_portfolio(
         n_workers = max(1, cpu_count() - 1)  # Leave one CPU free
     
     try:
-        returns = calculate_daily_returns(prices)
-        returns_array = returns.values
-        
-        column_map = {stock: i for i, stock in enumerate(returns.columns)}
-        
-        # Get all stock combinations
-        all_stocks = prices.columns.tolist()
-        combinations = get_stock_combinations(all_stocks, n_select)
-        print(f"Generated {len(combinations)} combinations")
+        search_inputs, result_inputs = prepare_optimization(
+            prices, n_select, n_simulations, seed, precomputed
+        )
+        mean_returns, cov_matrix, combinations, weights_batch = search_inputs
         
         # Determine optimal chunk size if not specified
         if chunk_size is None:
@@ -88,72 +212,125 @@ def optimize_portfolio(
             chunk_size = min(chunk_size, 250)
             print(f"Using auto-calculated chunk size: {chunk_size}")
         
-        # Split combinations into chunks
+        # Split combinations into chunks, each chunk is only a (start, stop)
+        # slice of the shared combinations
         n_chunks = max(1, len(combinations) // chunk_size)
-        chunks = np.array_split(combinations, n_chunks)
+        chunks = [(i * len(combinations) // n_chunks, (i + 1) * len(combinations) // n_chunks) for i in range(n_chunks)]
         print(f"Processing in {len(chunks)} chunks using {n_workers} workers")
         
-     
-        
-        # Process combinations in parallel with chunks
-        with Pool(processes=n_workers, maxtasksperchild=100) as pool:
-            chunk_results = pool.map(process_combinations_chunk, [(chunk, returns_array, column_map, n_simulations) for chunk in chunks])
-        
-        # Flatten results and filter out None
-        results = [portfolio for chunk in chunk_results for portfolio in chunk if portfolio is not None]
-        
-        if not results:
-            raise ValueError("No valid portfolios found. All combinations failed.")
+        # Evaluate a promising combination first, so every worker starts
+        # with a good incumbent to prune against
+        best_portfolio = find_best_portfolio_from_batch(
+            mean_returns, cov_matrix, get_initial_combination(mean_returns, cov_matrix, n_select),
+            weights_batch
+        )
         
-        # Find best portfolio
-        best_portfolio = max(results, key=lambda x: x['sharpe_ratio'])
+        # Put the arrays every task needs in shared memory, so tasks only
+        # carry the bounds of their chunk
+        shared_arrays = {
+            'combinations': combinations,
+            'mean_returns': mean_returns,
+            'cov_matrix': cov_matrix,
+            'weights_batch': weights_batch
+        }
+        shared_blocks: List[SharedMemory] = []
+        shared_specs = {}
+        try:
+            for key, array in shared_arrays.items():
+                shm, shared_specs[key] = share_array(array)
+                shared_blocks.append(shm)
+            
+            # Process combinations in parallel with chunks. Workers are spawned
+            # because numba's threading layers are not all fork-safe once the
+            # parent has used them, and live for the whole run
+            context = get_context("spawn")
+            incumbent = context.Value('d', best_portfolio[0])
+            with context.Pool(
+                processes=n_workers,
+                initializer=init_worker,
+                initargs=(shared_specs, incumbent)
+            ) as pool:
+                # Keep a running best as chunk results stream in, chunks only
+                # return small tuples of the best Sharpe ratio and weights
+                for result in pool.imap_unordered(process_shared_chunk, chunks):
+                    if result is not None and result[0] > best_portfolio[0]:
+                        best_portfolio = result
+        finally:
+            for shm in shared_blocks:
+                shm.close()
+                shm.unlink()
         
-        return best_portfolio
+        # Only the overall winner is turned into a result dictionary
+        return build_portfolio_result(best_portfolio, *result_inputs)
     
     except Exception as e:
         print(f"Error in optimize_portfolio: {e}")
         raise 
 
 def optimize_portfolio_sequential(
-    prices: pd.DataFrame,
+    prices: pd.DataFrame = None,
     n_select: int = 25,
-    n_simulations: int = 1000
+    n_simulations: int = 1000,
+    chunk_size: int = 250,
+    seed: int = None,
+    precomputed: Tuple = None
 ) -> Dict:
     """Optimize portfolio using sequential processing."""
+    # Run the numba kernel single-threaded, so the sequential version uses a
+    # single core like before and the comparison with the parallel one is fair
+    n_threads = get_num_threads()
+    set_num_threads(1)
     try:
-        returns = calculate_daily_returns(prices)
-        returns_array = returns.values
-        
-        column_map = {stock: i for i, stock in enumerate(returns.columns)}
+        search_inputs, result_inputs = prepare_optimization(
+            prices, n_select, n_simulations, seed, precomputed
+        )
+        mean_returns, cov_matrix, combinations, weights_batch = search_inputs
         
-        # Get all stock combinations
-        all_stocks = prices.columns.tolist()
-        combinations = get_stock_combinations(all_stocks, n_select)
-        print(f"Generated {len(combinations)} combinations")
+        # Evaluate a promising combination first, its Sharpe ratio is the
+        # incumbent used to skip combinations that cannot beat it
+        best_portfolio = find_best_portfolio_from_batch(
+            mean_returns, cov_matrix, get_initial_combination(mean_returns, cov_matrix, n_select),
+            weights_batch
+        )
         
-        results = []
-        # Process each combination sequentially
-        for combination in combinations:
-            try:
-                # Get column indices for this combination
-                indices = [column_map[stock] for stock in combination]
-                
-                # Process the combination
-                result = process_stock_combination(combination, returns_array, indices, n_simulations)
-                if result is not None:
-                    results.append(result)
-            except Exception as e:
-                print(f"Error processing combination {combination}: {e}")
-                continue
+        # Process each chunk sequentially, chunking keeps the batched arrays small.
+        # A chunk only returns a result when it beats the incumbent
+        for start in range(0, len(combinations), chunk_size):
+            chunk = combinations[start:start + chunk_size]
+            result = process_combinations_chunk((chunk, mean_returns, cov_matrix, weights_batch, best_portfolio[0]))
+            if result is not None:
+                best_portfolio = result
         
-        if not results:
-            raise ValueError("No valid portfolios found. All combinations failed.")
+        # Only the overall winner is turned into a result dictionary
+        return build_portfolio_result(best_portfolio, *result_inputs)
+    
+    except Exception as e:
+        print(f"Error in optimize_portfolio_sequential: {e}")
+        raise
+    finally:
+        set_num_threads(n_threads)
+
+def optimize_portfolio_gpu(
+    prices: pd.DataFrame = None,
+    n_select: int = 25,
+    n_simulations: int = 1000,
+    block_size: int = 1024,
+    seed: int = None,
+    precomputed: Tuple = None
+) -> Dict:
+    """Optimize portfolio on the GPU using CuPy."""
+    try:
+        search_inputs, result_inputs = prepare_optimization(
+            prices, n_select, n_simulations, seed, precomputed
+        )
+        mean_returns, cov_matrix, combinations, weights_batch = search_inputs
         
-        # Find best portfolio
-        best_portfolio = max(results, key=lambda x: x['sharpe_ratio'])
+        best_portfolio = find_best_portfolio_gpu(
+            mean_returns, cov_matrix, combinations, weights_batch, block_size
+        )
         
-        return best_portfolio
+        return build_portfolio_result(best_portfolio, *result_inputs)
     
     except Exception as e:
-        print(f"Error in optimize_portfolio_sequential: {e}")
-        raise 
\ No newline at end of file
+        print(f"Error in optimize_portfolio_gpu: {e}")
+        raise
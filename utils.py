@@ -1,7 +1,17 @@
 import numpy as np
 import pandas as pd
-from typing import List, Tuple, Dict
-from itertools import combinations
+from typing import List, Optional, Tuple, Dict
+from itertools import chain, combinations
+from math import comb
+from contextlib import nullcontext
+from numba import njit, prange
+
+try:
+    import cupy as cp
+    import cupyx
+except ImportError:
+    # CuPy is optional, it is only needed to run the optimization on the GPU
+    cp = None
 
 def calculate_daily_returns(prices: pd.DataFrame) -> pd.DataFrame:
     """Calculate daily returns for a price dataframe.
@@ -12,35 +22,228 @@ def calculate_daily_returns(prices: pd.DataFrame) -> pd.DataFrame:
     Returns:
         DataFrame with daily returns
     """ 
-    return prices.pct_change().dropna()
+    # Plain numpy division avoids the overhead of pct_change and dropna
+    price_array = prices.to_numpy(dtype=np.float64)
+    
+    # Forward fill missing prices like pct_change does by default, so a gap
+    # has a 0 return and the move is counted on the next day with a price
+    rows = np.where(np.isnan(price_array), 0, np.arange(len(price_array))[:, None])
+    np.maximum.accumulate(rows, axis=0, out=rows)
+    price_array = price_array[rows, np.arange(price_array.shape[1])]
+    
+    returns_array = price_array[1:] / price_array[:-1] - 1.0
+    
+    # Drop the days before every stock has a price, like dropna would
+    valid_rows = ~np.isnan(returns_array).any(axis=1)
+    return pd.DataFrame(
+        returns_array[valid_rows],
+        index=prices.index[1:][valid_rows],
+        columns=prices.columns
+    )
 
-def calculate_portfolio_metrics_vectorized(returns_array: np.ndarray, weights_batch: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
-    """Calculate portfolio metrics for a batch of weight vectors at once.
+def calculate_annualized_statistics(returns_array: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Calculate annualized mean returns and covariance matrix for all assets.
     
     Args:
         returns_array: NumPy array with daily returns (days x assets)
-        weights_batch: NumPy array with multiple weight vectors (portfolios x assets)
         
     Returns:
-        Tuple of (sharpe_ratios, annual_returns, annual_volatilities)
+        Tuple of (mean_returns, cov_matrix), both annualized
     """
-    # Calculate daily portfolio returns for all weight combinations (Rp = r * w)
-    # We can do this efficiently by first calculating mean returns for each asset
-    # and then multiplying by weights, which is mathematically equivalent to
-    # calculating daily returns and then taking the mean
     mean_returns = np.mean(returns_array, axis=0) * 252  # Shape: (assets,)
-    portfolio_returns = weights_batch @ mean_returns  # Shape: (portfolios,)
+    cov_matrix = np.cov(returns_array.T) * 252  # Shape: (assets x assets)
+    return mean_returns, cov_matrix
+
+def calculate_asset_statistics(prices: pd.DataFrame) -> Tuple[List[str], np.ndarray, np.ndarray]:
+    """Calculate the annualized statistics of every stock from its prices.
+    
+    The daily returns only live inside this function, so callers keep just
+    the small statistics arrays and not the returns DataFrame.
+    
+    Args:
+        prices: DataFrame with stock prices
+        
+    Returns:
+        Tuple of (stocks, mean_returns, cov_matrix), where stocks are the
+        tickers in the column order of the statistics
+    """
+    returns = calculate_daily_returns(prices)
+    mean_returns, cov_matrix = calculate_annualized_statistics(returns.to_numpy())
+    return returns.columns.tolist(), mean_returns, cov_matrix
+
+def calculate_portfolio_metrics_vectorized(
+    mean_returns: np.ndarray,
+    cov_matrix: np.ndarray,
+    combination_indices: np.ndarray,
+    weights_batch: np.ndarray,
+    xp=np
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Calculate portfolio metrics for a batch of combinations and weight vectors at once.
+    
+    Args:
+        mean_returns: Annualized mean returns of all assets (assets,)
+        cov_matrix: Annualized covariance matrix of all assets, factorized in its own precision (assets x assets)
+        combination_indices: Asset indices of each combination (combinations x selected)
+        weights_batch: NumPy array with multiple weight vectors (portfolios x selected)
+        xp: Array module of the inputs, numpy or cupy
+        
+    Returns:
+        Tuple of (sharpe_ratios, annual_returns, annual_volatilities),
+        each with shape (combinations x portfolios)
+    """
+    # Gather the statistics of every combination from the full universe
+    selected_means = mean_returns[combination_indices]  # Shape: (combinations x selected)
+    selected_covs = cov_matrix[
+        combination_indices[:, :, None], combination_indices[:, None, :]
+    ]  # Shape: (combinations x selected x selected)
+    
+    # The products with the weights run in the precision of the weights
+    dtype = weights_batch.dtype
+    portfolio_returns = selected_means.astype(dtype, copy=False) @ weights_batch.T  # Shape: (combinations x portfolios)
 
-    cov_matrix = np.cov(returns_array.T)  # Shape: (assets x assets)
-    cov_w = np.dot(weights_batch, cov_matrix.T)  # Shape: (portfolios x assets)
-    portfolio_variances = np.sum(cov_w * weights_batch, axis=1)  # Shape: (portfolios,)
-    portfolio_volatilities = np.sqrt(portfolio_variances) * np.sqrt(252)  # Annualize
+    # With cov = L @ L.T the variance w @ cov @ w is the squared norm of L.T @ w,
+    # so one factorization per combination replaces the quadratic form
+    try:
+        # CuPy only reports a failed factorization when asked to
+        with cupyx.errstate(linalg='raise') if xp is not np else nullcontext():
+            cholesky_factors = xp.linalg.cholesky(selected_covs).astype(dtype, copy=False)  # Shape: (combinations x selected x selected)
+        lw = xp.swapaxes(cholesky_factors, 1, 2) @ weights_batch.T  # Shape: (combinations x selected x portfolios)
+        portfolio_variances = xp.einsum('cap,cap->cp', lw, lw)  # Shape: (combinations x portfolios)
+    except np.linalg.LinAlgError:
+        # A rank-deficient covariance (fewer days than stocks, or collinear
+        # stocks) has no Cholesky factor, so the quadratic form is used instead
+        portfolio_variances = xp.einsum(
+            'pa,cab,pb->cp', weights_batch, selected_covs.astype(dtype, copy=False), weights_batch
+        )
+    portfolio_volatilities = xp.sqrt(portfolio_variances)  # Already annualized
     
     # Calculate Sharpe ratios
     sharpe_ratios = portfolio_returns / portfolio_volatilities
     
     return sharpe_ratios, portfolio_returns, portfolio_volatilities
 
+@njit(cache=True)
+def cholesky_numba(matrix: np.ndarray, factor: np.ndarray) -> bool:
+    """Write the lower Cholesky factor of a symmetric matrix into factor.
+    
+    Unlike np.linalg.cholesky this does not raise when the matrix is not
+    positive definite, which numba cannot report from a parallel loop.
+    
+    Returns:
+        True if the matrix was factorized, False if a pivot was not positive
+    """
+    n = matrix.shape[0]
+    for j in range(n):
+        pivot = matrix[j, j]
+        for k in range(j):
+            pivot -= factor[j, k] * factor[j, k]
+        if not pivot > 0.0:
+            return False
+        factor[j, j] = np.sqrt(pivot)
+        for i in range(j + 1, n):
+            value = matrix[i, j]
+            for k in range(j):
+                value -= factor[i, k] * factor[j, k]
+            factor[i, j] = value / factor[j, j]
+    return True
+
+# All fastmath flags except nnan/ninf, an infinite incumbent must compare correctly
+@njit(parallel=True, fastmath={'nsz', 'arcp', 'contract', 'afn', 'reassoc'}, cache=True)
+def calculate_best_metrics_numba(
+    mean_returns: np.ndarray,
+    cov_matrix: np.ndarray,
+    combination_indices: np.ndarray,
+    weights_batch: np.ndarray,
+    incumbent: float,
+    out_sharpe: np.ndarray,
+    out_weights: np.ndarray
+) -> None:
+    """Numba version of calculate_portfolio_metrics_vectorized that keeps only the best weights.
+    
+    Runs in parallel over the combinations, so only a (portfolios x selected)
+    buffer per combination is allocated instead of the full
+    (combinations x selected x portfolios) intermediate. The variance uses the
+    Cholesky factor of each combination's covariance, so all weight vectors
+    are handled by a single matrix product. The maximum Sharpe ratio of each
+    combination is tracked while its weights are evaluated, so the
+    (combinations x portfolios) metrics are never stored.
+    
+    The same factor gives an upper bound on the Sharpe ratio of any weights
+    for the combination, ||L^-1 @ mean||, the Sharpe ratio of the
+    unconstrained tangency portfolio. Combinations whose bound is not above
+    the incumbent are skipped and their Sharpe ratio is set to the bound,
+    so they can never beat the incumbent.
+    
+    Args:
+        mean_returns: Annualized mean returns of all assets (assets,)
+        cov_matrix: Annualized covariance matrix of all assets (assets x assets)
+        combination_indices: Asset indices of each combination (combinations x selected)
+        weights_batch: NumPy array with multiple weight vectors (portfolios x selected)
+        incumbent: Best Sharpe ratio found so far, -inf to evaluate everything
+        out_sharpe: Output array for the best Sharpe ratio of each combination (combinations,)
+        out_weights: Output array for the index of the best weights of each combination (combinations,)
+    """
+    n_combinations, n_selected = combination_indices.shape
+    n_portfolios = weights_batch.shape[0]
+    
+    for c in prange(n_combinations):
+        # Gather the statistics of this combination once for all weights
+        indices = combination_indices[c]
+        # The factorization and the bound run in float64, a covariance that
+        # is positive definite can lose that when rounded to float32
+        selected_means = np.empty(n_selected, dtype=np.float64)
+        selected_cov = np.empty((n_selected, n_selected), dtype=np.float64)
+        for a in range(n_selected):
+            selected_means[a] = mean_returns[indices[a]]
+            for b in range(n_selected):
+                selected_cov[a, b] = cov_matrix[indices[a], indices[b]]
+        cholesky_factor = np.zeros((n_selected, n_selected), dtype=np.float64)
+        factorized = cholesky_numba(selected_cov, cholesky_factor)
+        
+        max_sharpe = np.inf
+        if factorized:
+            # Upper bound on the Sharpe ratio by forward substitution of L @ z = mean
+            z = np.empty(n_selected, dtype=np.float64)
+            for a in range(n_selected):
+                z_a = selected_means[a]
+                for b in range(a):
+                    z_a -= cholesky_factor[a, b] * z[b]
+                z[a] = z_a / cholesky_factor[a, a]
+            max_sharpe = np.sqrt(np.dot(z, z))
+        
+        if max_sharpe <= incumbent:
+            out_sharpe[c] = max_sharpe
+            out_weights[c] = 0
+        else:
+            # Variance is the squared norm of L.T @ w, computed for all weights
+            # with one matrix product. Without a factor it is w @ (cov @ w).
+            # The products run in the precision of the weights
+            dtype = weights_batch.dtype
+            portfolio_returns = weights_batch @ selected_means.astype(dtype)
+            if factorized:
+                lw = weights_batch @ cholesky_factor.astype(dtype)
+            else:
+                lw = weights_batch @ selected_cov.astype(dtype)
+            
+            best_sharpe = -np.inf
+            best_p = 0
+            for p in range(n_portfolios):
+                portfolio_variance = 0.0
+                if factorized:
+                    for a in range(n_selected):
+                        portfolio_variance += lw[p, a] * lw[p, a]
+                else:
+                    for a in range(n_selected):
+                        portfolio_variance += lw[p, a] * weights_batch[p, a]
+                
+                sharpe_ratio = portfolio_returns[p] / np.sqrt(portfolio_variance)
+                if sharpe_ratio > best_sharpe:
+                    best_sharpe = sharpe_ratio
+                    best_p = p
+            
+            out_sharpe[c] = best_sharpe
+            out_weights[c] = best_p
+
 def calculate_portfolio_return(returns_array: np.ndarray, weights: np.ndarray) -> float:
     """Calculate the annualized portfolio return.
     
@@ -86,39 +289,100 @@ def calculate_sharpe_ratio(returns_array: np.ndarray, weights: np.ndarray) -> fl
     portfolio_volatility = calculate_portfolio_volatility(returns_array, weights)
     return float(portfolio_return / portfolio_volatility)
 
-def generate_valid_weights(n_assets: int, n_simulations: int = 1000) -> np.ndarray:
+def resolve_seed(seed: int = None) -> int:
+    """Return the seed of a run, drawing a fresh one from OS entropy if none is given.
+    
+    The seed is stored with the results, so every run can be reproduced.
+    """
+    if seed is None:
+        seed = int(np.random.SeedSequence().generate_state(1, np.uint64)[0])
+    return seed
+
+def generate_valid_weights(
+    n_assets: int,
+    n_simulations: int = 1000,
+    max_weight: float = 0.2,
+    rng: np.random.Generator = None
+) -> np.ndarray:
     """Generate valid random portfolio weights using vectorized operations.
     
+    Weights are drawn from a Dirichlet distribution, so every row already sums
+    to 1, and weights above max_weight are clipped with the excess spread over
+    the assets that are still below the cap.
+    
+    Args:
+        n_assets: Number of assets in each portfolio
+        n_simulations: Number of weight vectors to generate
+        max_weight: Maximum weight of a single asset
+        rng: NumPy random generator, a new one is created if not given
+        
     Returns:
         Array of valid weight vectors (each row is a valid weight vector)
     """
-    # First, generate significantly more weights to account for filtering
-    multiplier = 3  # Generate 3x more than needed to ensure we get enough
-    target_weights = min(n_simulations * multiplier, 10000)
+    if n_assets * max_weight < 1:
+        raise ValueError(f"{n_assets} assets with a maximum weight of {max_weight} cannot sum to 1")
+    if rng is None:
+        rng = np.random.default_rng()
     
-    weights = np.random.random((target_weights, n_assets))
-    weights = weights / weights.sum(axis=1, keepdims=True)
-    valid_mask = np.all(weights <= 0.2, axis=1)
-    valid_weights = weights[valid_mask]
+    # A concentration of 3 gives about the same spread as normalizing
+    # uniform draws, which is how the weights used to be sampled
+    weights = rng.dirichlet(np.full(n_assets, 3.0), size=n_simulations)
     
-    # If we don't have enough weights, generate more
-    if len(valid_weights) < n_simulations:
-        return generate_valid_weights(n_assets, n_simulations)
+    # Water-filling on the rows that still have a weight above the cap, valid
+    # rows are never touched again. Every pass caps at least one more asset
+    # in each remaining row, so this ends after at most n_assets passes
+    rows = np.flatnonzero(np.any(weights > max_weight, axis=1))
+    while rows.size:
+        capped = np.minimum(weights[rows], max_weight)
+        free = capped < max_weight
+        excess = 1 - capped.sum(axis=1, keepdims=True)
+        capped += excess * free / np.maximum(free.sum(axis=1, keepdims=True), 1)
+        weights[rows] = capped
+        rows = rows[np.any(capped > max_weight, axis=1)]
     
-    # Take exactly n_simulations weights
-    return valid_weights[:n_simulations]
+    return weights
 
-def get_stock_combinations(all_stocks: List[str], n_select: int = 25) -> List[Tuple[str, ...]]:
-    """Generate combinations of n_select stocks from all_stocks.
+def get_stock_combinations(n_stocks: int, n_select: int = 25) -> np.ndarray:
+    """Generate combinations of n_select stocks out of n_stocks.
+    
+    Choosing n_select stocks is the same as choosing the n_stocks - n_select
+    stocks to leave out, so the smaller of the two subsets is enumerated
+    (for 25 out of 30 only 5-tuples are generated).
     
     Args:
-        all_stocks: List of all available stock symbols
+        n_stocks: Number of available stocks
         n_select: Number of stocks to select
         
     Returns:
-        List of stock combinations
+        Contiguous int32 array with the column indices of one combination per row
+        (combinations x n_select)
+    """
+    n_excluded = n_stocks - n_select
+    if n_excluded >= n_select:
+        return np.fromiter(
+            chain.from_iterable(combinations(range(n_stocks), n_select)), dtype=np.int32
+        ).reshape(comb(n_stocks, n_select), n_select)
+    
+    excluded = np.fromiter(
+        chain.from_iterable(combinations(range(n_stocks), n_excluded)), dtype=np.int32
+    ).reshape(comb(n_stocks, n_excluded), n_excluded)
+    included = np.ones((len(excluded), n_stocks), dtype=bool)
+    included[np.arange(len(excluded))[:, None], excluded] = False
+    # nonzero walks the mask row by row, so each row keeps its indices sorted
+    return np.nonzero(included)[1].astype(np.int32).reshape(len(excluded), n_select)
+
+def get_initial_combination(mean_returns: np.ndarray, cov_matrix: np.ndarray, n_select: int = 25) -> np.ndarray:
+    """Pick the n_select stocks with the highest individual Sharpe ratios.
+    
+    The combination is a cheap guess of a good portfolio, evaluating it first
+    gives an incumbent that lets the search skip weaker combinations.
+    
+    Returns:
+        Sorted column indices of the selected stocks (1 x n_select)
     """
-    return list(combinations(all_stocks, n_select))
+    individual_sharpes = mean_returns / np.sqrt(np.diag(cov_matrix))
+    best_stocks = np.sort(np.argsort(individual_sharpes)[-n_select:])
+    return best_stocks.astype(np.int32).reshape(1, n_select)
 
 def evaluate_portfolio(returns_array: np.ndarray, weights: np.ndarray) -> Dict[str, float]:
     """Evaluate a portfolio using various metrics.
@@ -137,26 +401,123 @@ def evaluate_portfolio(returns_array: np.ndarray, weights: np.ndarray) -> Dict[s
     }
 
 def find_best_portfolio_from_batch(
-    returns_array: np.ndarray, 
+    mean_returns: np.ndarray,
+    cov_matrix: np.ndarray,
+    combination_indices: np.ndarray,
     weights_batch: np.ndarray, 
-    combination: Tuple[str, ...]
+    incumbent: float = -np.inf
+) -> Optional[Tuple]:
+    """Find the best portfolio from a batch of combinations and weights using vectorized operations.
+    
+    Returns:
+        Tuple of (sharpe_ratio, combination, weights_index) of the best
+        portfolio, where combination holds the column indices of its stocks
+        and weights_index is its row in weights_batch, or None if no
+        portfolio in the batch beats the incumbent Sharpe ratio
+    """
+    # Find the best weights of every combination with the compiled kernel,
+    # in the precision of the weights
+    n_combinations = len(combination_indices)
+    dtype = weights_batch.dtype
+    sharpe_ratios = np.empty(n_combinations, dtype)
+    best_weights = np.empty(n_combinations, np.int64)
+    calculate_best_metrics_numba(
+        mean_returns, cov_matrix, combination_indices, weights_batch, incumbent,
+        sharpe_ratios, best_weights
+    )
+    
+    # Find the combination with the maximum Sharpe ratio
+    best_combination = np.argmax(sharpe_ratios)
+    if sharpe_ratios[best_combination] <= incumbent:
+        return None
+    
+    return (
+        sharpe_ratios[best_combination],
+        combination_indices[best_combination],
+        best_weights[best_combination]
+    )
+
+def build_portfolio_result(
+    best_portfolio: Tuple,
+    all_stocks: List[str],
+    mean_returns: np.ndarray,
+    cov_matrix: np.ndarray,
+    weights_batch: np.ndarray,
+    seed: int
 ) -> Dict:
-    """Find the best portfolio from a batch of weights using vectorized operations."""
-    # Calculate metrics for all weights using vectorized operations
+    """Build the result dictionary from a tuple returned by find_best_portfolio_from_batch.
+    
+    The search may run in float32, so the metrics of the winner are recomputed
+    from the float64 statistics and weights before they are reported.
+    
+    Args:
+        best_portfolio: Tuple of (sharpe_ratio, combination, weights_index)
+        all_stocks: Tickers in the column order of the combination indices
+        mean_returns: Annualized mean returns of every stock, in float64
+        cov_matrix: Annualized covariance matrix of every stock, in float64
+        weights_batch: Weights the search was run with, in float64
+        seed: Seed the weights were generated with
+        
+    Returns:
+        Dictionary with the stocks, weights and metrics of the portfolio
+    """
+    _, combination, weights_index = best_portfolio
+    stocks = [all_stocks[i] for i in combination]
+    weights = weights_batch[weights_index]
     sharpe_ratios, returns, volatilities = calculate_portfolio_metrics_vectorized(
-        returns_array, weights_batch
+        mean_returns, cov_matrix, combination[np.newaxis], weights[np.newaxis]
     )
     
-    # Find the index with the maximum Sharpe ratio
-    best_idx = np.argmax(sharpe_ratios)
+    # Numpy scalars are kept as is, save_results serializes them with orjson
+    return {
+        'stocks': stocks,
+        'weights': dict(zip(stocks, weights)),
+        'sharpe_ratio': sharpe_ratios[0, 0],
+        'annual_return': returns[0, 0],
+        'annual_volatility': volatilities[0, 0],
+        'seed': seed
+    }
+
+def find_best_portfolio_gpu(
+    mean_returns: np.ndarray,
+    cov_matrix: np.ndarray,
+    combination_indices: np.ndarray,
+    weights_batch: np.ndarray,
+    block_size: int = 1024
+) -> Tuple:
+    """Find the best portfolio from all combinations and weights on the GPU using CuPy.
     
-    # Convert to Python types for JSON serialization
-    weights_dict = {stock: float(weight) for stock, weight in zip(combination, weights_batch[best_idx])}
+    The inputs are uploaded once and the combinations are evaluated in blocks,
+    keeping only the best Sharpe ratio of each combination on the device.
+    The block size bounds the (block_size x selected x portfolios) intermediate.
     
-    return {
-        'stocks': list(combination),
-        'weights': weights_dict,
-        'sharpe_ratio': float(sharpe_ratios[best_idx]),
-        'annual_return': float(returns[best_idx]),
-        'annual_volatility': float(volatilities[best_idx])
-    } 
\ No newline at end of file
+    Returns:
+        Tuple of (sharpe_ratio, combination, weights_index), like
+        find_best_portfolio_from_batch
+    """
+    if cp is None:
+        raise ImportError("CuPy is required to run the optimization on the GPU")
+    
+    mean_gpu = cp.asarray(mean_returns)
+    cov_gpu = cp.asarray(cov_matrix)
+    indices_gpu = cp.asarray(combination_indices)
+    weights_gpu = cp.asarray(weights_batch)
+    
+    n_combinations = len(combination_indices)
+    best_sharpes = cp.empty(n_combinations, dtype=weights_gpu.dtype)
+    best_weights = cp.empty(n_combinations, dtype=cp.int64)
+    for start in range(0, n_combinations, block_size):
+        sharpe_ratios, _, _ = calculate_portfolio_metrics_vectorized(
+            mean_gpu, cov_gpu, indices_gpu[start:start + block_size], weights_gpu, xp=cp
+        )
+        best_weights[start:start + block_size] = sharpe_ratios.argmax(axis=1)
+        best_sharpes[start:start + block_size] = sharpe_ratios.max(axis=1)
+    
+    # Only the winner's indices are copied back, build_portfolio_result
+    # recomputes its metrics
+    best_combination = int(best_sharpes.argmax())
+    return (
+        float(best_sharpes[best_combination]),
+        combination_indices[best_combination],
+        int(best_weights[best_combination])
+    )